@@ -0,0 +1,120 @@
+import json
+import logging
+import threading
+import time
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from strapi_service import get_products
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_KEY = 'bot:snapshot'
+CATALOG_REFRESH_INTERVAL = 300
+CATALOG_MIN_REFRESH_INTERVAL = 30
+
+_snapshot_lock = threading.Lock()
+
+
+def build_menu_keyboard(menu_items):
+    """Собирает клавиатуру меню товаров."""
+    menu_buttons = [
+        [InlineKeyboardButton(item.get('title'), callback_data=str(item.get('id')))]
+        for item in menu_items
+    ]
+    menu_buttons.append([
+        InlineKeyboardButton("🛒 Моя корзина", callback_data='show_cart')
+    ])
+    return InlineKeyboardMarkup(menu_buttons)
+
+
+def _set_catalog(bot_data, menu_items):
+    """Обновляет каталог и клавиатуру, забывает file_id удаленных картинок.
+
+    menu_items присваивается последним: обработчики проверяют наличие
+    каталога и не должны увидеть его без клавиатуры и file_id.
+    """
+    image_urls = {item.get('small_image_url') for item in menu_items}
+    bot_data['image_file_ids'] = {
+        image_url: file_id
+        for image_url, file_id in bot_data.get('image_file_ids', {}).items()
+        if image_url in image_urls
+    }
+    bot_data['menu_keyboard'] = build_menu_keyboard(menu_items)
+    bot_data['menu_items'] = menu_items
+
+
+def save_snapshot(bot_data):
+    """Сохраняет каталог и file_id картинок в Redis."""
+    with _snapshot_lock:
+        snapshot = {
+            'menu_items': bot_data['menu_items'],
+            'image_file_ids': bot_data['image_file_ids']
+        }
+        bot_data['db'].set(SNAPSHOT_KEY, json.dumps(snapshot, ensure_ascii=False, separators=(',', ':')))
+
+
+def load_snapshot(bot_data):
+    """Загружает сохраненный снимок в bot_data. Возвращает True, если снимок найден."""
+    raw_snapshot = bot_data['db'].get(SNAPSHOT_KEY)
+    if not raw_snapshot:
+        return False
+
+    try:
+        snapshot = json.loads(raw_snapshot)
+        bot_data['image_file_ids'] = snapshot.get('image_file_ids', {})
+        _set_catalog(bot_data, snapshot['menu_items'])
+    except (ValueError, KeyError) as e:
+        logger.error(f"Не удалось загрузить снимок бота: {e}")
+        return False
+
+    logger.info(f"Загружен снимок каталога: {len(bot_data['menu_items'])} товаров")
+    return True
+
+
+def is_catalog_stale(bot_data):
+    """Проверяет, давно ли каталог сверялся со Strapi."""
+    checked_at = bot_data.get('catalog_checked_at')
+    return checked_at is None or time.monotonic() - checked_at > CATALOG_MIN_REFRESH_INTERVAL
+
+
+def refresh_catalog(bot_data):
+    """Сверяет каталог со Strapi и сохраняет снимок, если каталог изменился."""
+    bot_data['catalog_checked_at'] = time.monotonic()
+    menu_items = get_products(bot_data['strapi_api_token'], bot_data['strapi_url'])
+    with _snapshot_lock:
+        if menu_items == bot_data.get('menu_items'):
+            return
+        _set_catalog(bot_data, menu_items)
+    logger.info(f"Каталог обновлен: {len(menu_items)} товаров")
+    save_snapshot(bot_data)
+
+
+def refresh_catalog_job(context):
+    """Периодическая задача сверки каталога со Strapi."""
+    try:
+        refresh_catalog(context.bot_data)
+    except Exception as e:
+        logger.error(f"Ошибка обновления каталога: {e}", exc_info=True)
+
+
+def remember_image_file_id(bot_data, image_url, message):
+    """Запоминает file_id отправленной картинки, чтобы не скачивать ее повторно."""
+    if not message or not message.photo:
+        return
+    with _snapshot_lock:
+        bot_data['image_file_ids'] = {
+            **bot_data.get('image_file_ids', {}),
+            image_url: message.photo[-1].file_id
+        }
+    save_snapshot(bot_data)
+
+
+def forget_image_file_id(bot_data, image_url):
+    """Забывает file_id картинки, который Telegram больше не принимает."""
+    with _snapshot_lock:
+        image_file_ids = dict(bot_data.get('image_file_ids', {}))
+        if image_file_ids.pop(image_url, None) is None:
+            return
+        bot_data['image_file_ids'] = image_file_ids
+    save_snapshot(bot_data)
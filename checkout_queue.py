@@ -0,0 +1,237 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+
+from strapi_service import (
+    create_client, get_products_from_cart, create_order, delete_cart_items
+)
+
+logger = logging.getLogger(__name__)
+
+CHECKOUT_QUEUE = 'checkout:queue'
+CHECKOUT_PROCESSING_QUEUE = 'checkout:processing'
+CHECKOUT_DELAYED_QUEUE = 'checkout:delayed'
+CHECKOUT_FAILED_QUEUE = 'checkout:failed'
+CHECKOUT_JOB_PREFIX = 'checkout:job:'
+CHECKOUT_LOCK_PREFIX = 'checkout:lock:'
+CHECKOUT_LOCK_TTL = 60
+CHECKOUT_PROGRESS_PREFIX = 'checkout:progress:'
+CHECKOUT_PROGRESS_TTL = 24 * 60 * 60
+CHECKOUT_MAX_ATTEMPTS = 5
+CHECKOUT_POLL_TIMEOUT = 5
+CHECKOUT_RETRY_DELAY = 5
+CHECKOUT_ERROR_DELAY = 1
+
+
+def enqueue_checkout(redis_db, tg_id: str, email: str, idempotency_key: str) -> bool:
+    """Ставит оформление заказа в очередь.
+
+    Ключ идемпотентности строится из входящего сообщения, поэтому повторная
+    доставка того же сообщения не создает второй задачи.
+    Возвращает False, если задача с этим ключом уже была поставлена.
+    """
+    job_key = f'{CHECKOUT_JOB_PREFIX}{idempotency_key}'
+    if not redis_db.set(job_key, 1, ex=CHECKOUT_PROGRESS_TTL, nx=True):
+        logger.info(f"Оформление заказа {idempotency_key} уже в очереди, повтор пропущен")
+        return False
+
+    job = {
+        'idempotency_key': idempotency_key,
+        'tg_id': tg_id,
+        'email': email,
+        'attempts': 0
+    }
+    try:
+        redis_db.lpush(CHECKOUT_QUEUE, json.dumps(job))
+    except Exception:
+        redis_db.delete(job_key)
+        raise
+    logger.info(f"Оформление заказа {idempotency_key} пользователя {tg_id} поставлено в очередь")
+    return True
+
+
+def get_cart_order_key(tg_id: str, cart_items) -> str:
+    """Строит ключ заказа по составу корзины.
+
+    Две задачи, оформляющие одну и ту же неочищенную корзину, получают
+    одинаковый ключ, поэтому create_order вернет уже созданный заказ.
+    """
+    cart_state = sorted((item['cart_item_id'], item['quantity']) for item in cart_items)
+    digest = hashlib.sha1(json.dumps(cart_state).encode()).hexdigest()[:16]
+    return f'{tg_id}:{digest}'
+
+
+def notify_user(send_scheduler, tg_id, text):
+    """Сообщает пользователю результат оформления заказа."""
+    if send_scheduler:
+        send_scheduler.send_message(chat_id=tg_id, text=text)
+
+
+def process_checkout_job(job, redis_db, strapi_api_token, strapi_url, send_scheduler=None):
+    """Оформляет заказ: клиент, снимок корзины в заказ, очистка корзины.
+
+    Результат каждого шага сохраняется в Redis под ключом идемпотентности,
+    поэтому повторная обработка задачи продолжает с прерванного шага.
+    """
+    tg_id = job['tg_id']
+    progress_key = f"{CHECKOUT_PROGRESS_PREFIX}{job['idempotency_key']}"
+    progress = redis_db.hgetall(progress_key)
+
+    if progress.get('done'):
+        return
+
+    client_id = progress.get('client_id')
+    if not client_id:
+        client_id = create_client(tg_id, strapi_api_token, strapi_url, job['email'])
+        redis_db.hset(progress_key, 'client_id', client_id)
+        redis_db.expire(progress_key, CHECKOUT_PROGRESS_TTL)
+
+    cart_items = json.loads(progress['cart_items']) if progress.get('cart_items') else None
+    if cart_items is None:
+        cart_items = get_products_from_cart(tg_id, strapi_api_token, strapi_url)
+        redis_db.hset(progress_key, 'cart_items', json.dumps(cart_items))
+
+    if not cart_items:
+        logger.info(f"Корзина пользователя {tg_id} пуста, заказ {job['idempotency_key']} не создан")
+        redis_db.hset(progress_key, 'done', 1)
+        notify_user(send_scheduler, tg_id, "Корзина пуста, заказ не создан.")
+        return
+
+    order_id = progress.get('order_id')
+    if not order_id:
+        order_id = create_order(
+            tg_id, int(client_id), cart_items, get_cart_order_key(tg_id, cart_items),
+            strapi_api_token, strapi_url
+        )
+        redis_db.hset(progress_key, 'order_id', order_id)
+        logger.info(f"Создан заказ {order_id} для пользователя {tg_id}")
+
+    delete_cart_items(
+        [item['cart_item_id'] for item in cart_items],
+        strapi_api_token, strapi_url
+    )
+    redis_db.hset(progress_key, 'done', 1)
+    notify_user(send_scheduler, tg_id, f"Заказ №{order_id} оформлен.")
+
+
+def delay_job(redis_db, job, delay):
+    """Откладывает задачу в очередь повторов на delay секунд."""
+    redis_db.zadd(CHECKOUT_DELAYED_QUEUE, {json.dumps(job): time.time() + delay})
+
+
+def schedule_retry(redis_db, job) -> bool:
+    """Откладывает повтор задачи с экспоненциальной задержкой или переносит ее в failed.
+
+    Возвращает False, если попытки исчерпаны.
+    """
+    job['attempts'] += 1
+    if job['attempts'] >= CHECKOUT_MAX_ATTEMPTS:
+        redis_db.lpush(CHECKOUT_FAILED_QUEUE, json.dumps(job))
+        return False
+
+    delay_job(redis_db, job, CHECKOUT_RETRY_DELAY * 2 ** (job['attempts'] - 1))
+    return True
+
+
+def move_due_retries(redis_db):
+    """Возвращает в очередь отложенные задачи, время повтора которых наступило."""
+    for raw_job in redis_db.zrangebyscore(CHECKOUT_DELAYED_QUEUE, 0, time.time()):
+        if redis_db.zrem(CHECKOUT_DELAYED_QUEUE, raw_job):
+            redis_db.lpush(CHECKOUT_QUEUE, raw_job)
+
+
+def restore_processing_jobs(redis_db):
+    """Возвращает в очередь задачи, прерванные остановкой бота."""
+    restored_count = 0
+    while redis_db.rpoplpush(CHECKOUT_PROCESSING_QUEUE, CHECKOUT_QUEUE):
+        restored_count += 1
+    if restored_count:
+        logger.info(f"Возвращено в очередь незавершенных заказов: {restored_count}")
+
+
+def handle_checkout_job(raw_job, redis_db, strapi_api_token, strapi_url, send_scheduler=None):
+    """Обрабатывает одну задачу и убирает ее из списка выполняемых.
+
+    Заказы одного пользователя оформляются по очереди: пока его задача
+    выполняется, следующая откладывается.
+    """
+    try:
+        job = json.loads(raw_job)
+    except ValueError:
+        logger.error(f"Некорректная задача оформления заказа: {raw_job}")
+        redis_db.lpush(CHECKOUT_FAILED_QUEUE, raw_job)
+        redis_db.lrem(CHECKOUT_PROCESSING_QUEUE, 1, raw_job)
+        return
+
+    lock_key = f"{CHECKOUT_LOCK_PREFIX}{job['tg_id']}"
+    if not redis_db.set(lock_key, job['idempotency_key'], ex=CHECKOUT_LOCK_TTL, nx=True):
+        delay_job(redis_db, job, CHECKOUT_RETRY_DELAY)
+        redis_db.lrem(CHECKOUT_PROCESSING_QUEUE, 1, raw_job)
+        return
+
+    try:
+        process_checkout_job(job, redis_db, strapi_api_token, strapi_url, send_scheduler)
+    except Exception as e:
+        logger.error(
+            f"Ошибка оформления заказа {job['idempotency_key']} "
+            f"(попытка {job['attempts'] + 1}): {e}",
+            exc_info=True
+        )
+        if not schedule_retry(redis_db, job):
+            notify_user(
+                send_scheduler, job['tg_id'],
+                "Не удалось оформить заказ. Пожалуйста, попробуйте позже."
+            )
+    finally:
+        if redis_db.get(lock_key) == job['idempotency_key']:
+            redis_db.delete(lock_key)
+    redis_db.lrem(CHECKOUT_PROCESSING_QUEUE, 1, raw_job)
+
+
+def checkout_worker(redis_db, strapi_api_token, strapi_url, send_scheduler, stop_event):
+    """Забирает задачи оформления заказа из очереди до остановки.
+
+    Задача переносится в список выполняемых атомарно и удаляется оттуда
+    только после обработки, поэтому при остановке бота она не теряется.
+    """
+    while not stop_event.is_set():
+        try:
+            move_due_retries(redis_db)
+            raw_job = redis_db.brpoplpush(
+                CHECKOUT_QUEUE, CHECKOUT_PROCESSING_QUEUE, timeout=CHECKOUT_POLL_TIMEOUT
+            )
+            if raw_job:
+                handle_checkout_job(raw_job, redis_db, strapi_api_token, strapi_url, send_scheduler)
+        except Exception as e:
+            logger.error(f"Ошибка обработчика очереди заказов: {e}", exc_info=True)
+            stop_event.wait(CHECKOUT_ERROR_DELAY)
+
+
+def start_checkout_workers(redis_db, strapi_api_token, strapi_url, send_scheduler, workers_count):
+    """Запускает пул фоновых обработчиков заказов.
+
+    Возвращает событие остановки и список потоков для stop_checkout_workers.
+    """
+    restore_processing_jobs(redis_db)
+
+    stop_event = threading.Event()
+    workers = []
+    for number in range(workers_count):
+        worker = threading.Thread(
+            target=checkout_worker,
+            args=(redis_db, strapi_api_token, strapi_url, send_scheduler, stop_event),
+            name=f'checkout-worker-{number}',
+            daemon=True
+        )
+        worker.start()
+        workers.append(worker)
+    return stop_event, workers
+
+
+def stop_checkout_workers(stop_event, workers):
+    """Останавливает обработчиков заказов и дожидается завершения текущих задач."""
+    stop_event.set()
+    for worker in workers:
+        worker.join()
@@ -0,0 +1,282 @@
+import logging
+import threading
+import time
+from collections import deque
+
+from telegram.error import RetryAfter, TelegramError
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+GLOBAL_RATE = 30
+PER_CHAT_RATE = 1
+PER_CHAT_BURST = 3
+BULK_QUEUE_SIZE = 100
+SENDER_THREADS = 4
+SEND_MAX_ATTEMPTS = 5
+BULK_FLOOD_LIMIT = 3
+
+
+class TokenBucket:
+    """Ограничитель частоты: rate токенов в секунду, не больше capacity."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def time_until_available(self, now):
+        """Возвращает, сколько секунд ждать до появления токена."""
+        self._refill(now)
+        pause = max(self.paused_until - now, 0)
+        if self.tokens >= 1:
+            return pause
+        return max(pause, (1 - self.tokens) / self.rate)
+
+    def pause(self, until):
+        """Запрещает выдачу токенов до момента until."""
+        self.paused_until = max(self.paused_until, until)
+
+    def consume(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity and self.paused_until <= now
+
+
+class SendScheduler:
+    """Очередь исходящих сообщений с учетом лимитов Telegram.
+
+    Сообщения отправляются пулом потоков с глобальным ограничением частоты
+    и ограничением на каждый чат. Интерактивные ответы всегда идут раньше
+    рассылки. Ответ 429 приостанавливает на retry_after только чат, получивший
+    его, и очередь рассылки, если это была рассылка. Вся отправка встает
+    на паузу, только если рассылка получает 429 BULK_FLOOD_LIMIT раз подряд.
+    """
+
+    def __init__(self, bot, global_rate=GLOBAL_RATE, per_chat_rate=PER_CHAT_RATE,
+                 bulk_queue_size=BULK_QUEUE_SIZE, sender_threads=SENDER_THREADS):
+        self.bot = bot
+        self.per_chat_rate = per_chat_rate
+        self.bulk_queue_size = bulk_queue_size
+        self.sender_threads = sender_threads
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets = {}
+        self._chats_in_flight = set()
+        self._lanes = {PRIORITY_INTERACTIVE: deque(), PRIORITY_BULK: deque()}
+        self._lane_paused_until = {PRIORITY_INTERACTIVE: 0, PRIORITY_BULK: 0}
+        self._paused_until = 0
+        self._bulk_flood_count = 0
+        self._condition = threading.Condition()
+        self._running = False
+
+    def start(self):
+        """Запускает потоки отправки."""
+        self._running = True
+        for number in range(self.sender_threads):
+            threading.Thread(target=self._run, name=f'sender-{number}', daemon=True).start()
+
+    def stop(self):
+        """Останавливает потоки отправки."""
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+
+    def send_message(self, chat_id, priority=PRIORITY_INTERACTIVE, on_sent=None, on_error=None, **kwargs):
+        """Ставит текстовое сообщение в очередь отправки."""
+        self._enqueue('send_message', chat_id, kwargs, priority, on_sent, on_error)
+
+    def send_photo(self, chat_id, priority=PRIORITY_INTERACTIVE, on_sent=None, on_error=None, **kwargs):
+        """Ставит фото в очередь отправки.
+
+        on_sent вызывается с отправленным сообщением, например чтобы
+        запомнить file_id картинки, а on_error - с ошибкой, если сообщение
+        так и не удалось отправить.
+        """
+        self._enqueue('send_photo', chat_id, kwargs, priority, on_sent, on_error)
+
+    def _enqueue(self, method, chat_id, kwargs, priority, on_sent=None, on_error=None):
+        job = {
+            'method': method,
+            'chat_id': chat_id,
+            'kwargs': kwargs,
+            'priority': priority,
+            'on_sent': on_sent,
+            'on_error': on_error,
+            'attempts': 0
+        }
+        with self._condition:
+            if priority == PRIORITY_BULK:
+                while self._running and len(self._lanes[PRIORITY_BULK]) >= self.bulk_queue_size:
+                    self._condition.wait()
+            self._lanes[priority].append(job)
+            self._condition.notify_all()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.per_chat_rate, PER_CHAT_BURST)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _take_job(self, now):
+        """Выбирает следующее сообщение или возвращает время ожидания.
+
+        Сообщения одного чата уходят по порядку: если первый в очереди
+        элемент чата ждет лимита, остальные сообщения этого чата пропускаются.
+        """
+        wait = max(self._paused_until - now, self._global_bucket.time_until_available(now))
+        if wait > 0:
+            return None, wait
+
+        wait = None
+        for priority in sorted(self._lanes):
+            lane = self._lanes[priority]
+            lane_wait = self._lane_paused_until[priority] - now
+            if lane_wait > 0:
+                if lane:
+                    wait = lane_wait if wait is None else min(wait, lane_wait)
+                continue
+            blocked_chats = set()
+            for job in lane:
+                chat_id = job['chat_id']
+                if chat_id in blocked_chats or chat_id in self._chats_in_flight:
+                    blocked_chats.add(chat_id)
+                    continue
+                chat_wait = self._chat_bucket(chat_id).time_until_available(now)
+                if chat_wait > 0:
+                    blocked_chats.add(chat_id)
+                    wait = chat_wait if wait is None else min(wait, chat_wait)
+                    continue
+                lane.remove(job)
+                return job, 0
+        return None, wait
+
+    def _prune_chat_buckets(self, now):
+        for chat_id in [chat_id for chat_id, bucket in self._chat_buckets.items()
+                        if chat_id not in self._chats_in_flight and bucket.is_full(now)]:
+            del self._chat_buckets[chat_id]
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._running:
+                    return
+                now = time.monotonic()
+                job, wait = self._take_job(now)
+                if job is None:
+                    self._condition.wait(wait)
+                    continue
+                self._global_bucket.consume(now)
+                self._chat_bucket(job['chat_id']).consume(now)
+                self._chats_in_flight.add(job['chat_id'])
+                if len(self._chat_buckets) > 10 * self.bulk_queue_size:
+                    self._prune_chat_buckets(now)
+                self._condition.notify_all()
+
+            retry = False
+            try:
+                retry = self._send(job)
+            finally:
+                with self._condition:
+                    self._chats_in_flight.discard(job['chat_id'])
+                    if retry:
+                        self._lanes[job['priority']].appendleft(job)
+                    self._condition.notify_all()
+
+    def _send(self, job):
+        """Отправляет сообщение. Возвращает True, если его нужно повторить."""
+        job['attempts'] += 1
+        try:
+            photo = job['kwargs'].get('photo')
+            if hasattr(photo, 'seek'):
+                photo.seek(0)
+            message = getattr(self.bot, job['method'])(chat_id=job['chat_id'], **job['kwargs'])
+        except RetryAfter as e:
+            logger.warning(
+                f"Telegram просит подождать {e.retry_after} с перед отправкой в чат {job['chat_id']}"
+            )
+            self._pause_after_flood(job, time.monotonic() + e.retry_after)
+            if job['attempts'] >= SEND_MAX_ATTEMPTS:
+                logger.error(
+                    f"Сообщение в чат {job['chat_id']} не отправлено "
+                    f"после {job['attempts']} попыток"
+                )
+                self._run_callback(job['on_error'], e)
+                return False
+            return True
+        except TelegramError as e:
+            logger.error(f"Ошибка отправки сообщения в чат {job['chat_id']}: {e}")
+            self._run_callback(job['on_error'], e)
+            return False
+        except Exception as e:
+            logger.error(f"Ошибка отправки сообщения в чат {job['chat_id']}: {e}", exc_info=True)
+            self._run_callback(job['on_error'], e)
+            return False
+
+        if job['priority'] == PRIORITY_BULK:
+            with self._condition:
+                self._bulk_flood_count = 0
+        self._run_callback(job['on_sent'], message)
+        return False
+
+    def _pause_after_flood(self, job, until):
+        """Приостанавливает отправку после ответа 429."""
+        with self._condition:
+            self._chat_bucket(job['chat_id']).pause(until)
+            if job['priority'] != PRIORITY_BULK:
+                return
+            self._lane_paused_until[PRIORITY_BULK] = max(self._lane_paused_until[PRIORITY_BULK], until)
+            self._bulk_flood_count += 1
+            if self._bulk_flood_count >= BULK_FLOOD_LIMIT:
+                logger.warning("Рассылка постоянно получает 429, вся отправка приостановлена")
+                self._paused_until = max(self._paused_until, until)
+
+    @staticmethod
+    def _run_callback(callback, argument):
+        if not callback:
+            return
+        try:
+            callback(argument)
+        except Exception as e:
+            logger.error(f"Ошибка обработки результата отправки: {e}", exc_info=True)
+
+
+def iter_chat_ids(redis_db, batch_size=500):
+    """Перебирает chat_id пользователей из Redis, не загружая их все в память."""
+    for key in redis_db.scan_iter(count=batch_size):
+        if key.lstrip('-').isdigit():
+            yield int(key)
+
+
+def broadcast(redis_db, scheduler, text):
+    """Рассылает сообщение всем пользователям через очередь рассылки."""
+    recipients_count = 0
+    for chat_id in iter_chat_ids(redis_db):
+        scheduler.send_message(chat_id, priority=PRIORITY_BULK, text=text)
+        recipients_count += 1
+    logger.info(f"Рассылка поставлена в очередь для {recipients_count} пользователей")
+    return recipients_count
+
+
+def start_broadcast(redis_db, scheduler, text):
+    """Запускает рассылку в отдельном потоке.
+
+    Очередь рассылки ограничена, поэтому перебор получателей идет со скоростью
+    отправки и не должен занимать потоки диспетчера.
+    """
+    thread = threading.Thread(
+        target=broadcast, args=(redis_db, scheduler, text), name='broadcast', daemon=True
+    )
+    thread.start()
+    return thread
@@ -1,4 +1,6 @@
 import logging
+import threading
+from functools import wraps
 from io import BytesIO
 from urllib.parse import urljoin
 from typing import List, Dict, Any, Optional, Union
@@ -7,6 +9,48 @@ import requests
 
 logger = logging.getLogger(__name__)
 
+_in_flight_lock = threading.Lock()
+_in_flight_calls = {}
+
+
+def single_flight(func):
+    """Объединяет одновременные одинаковые вызовы в один запрос.
+
+    Пока запрос с теми же аргументами выполняется, остальные вызовы ждут
+    и получают его результат или исключение. Результат не кэшируется:
+    следующий вызов после завершения снова идет в Strapi.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        key = (func.__name__, args, tuple(sorted(kwargs.items())))
+        with _in_flight_lock:
+            call = _in_flight_calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = {'event': threading.Event(), 'result': None, 'error': None}
+                _in_flight_calls[key] = call
+
+        if not is_leader:
+            call['event'].wait()
+            if call['error']:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = func(*args, **kwargs)
+            return call['result']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with _in_flight_lock:
+                del _in_flight_calls[key]
+            call['event'].set()
+
+    return wrapper
+
+
+@single_flight
 def get_products(strapi_api_token: str, strapi_url: str) -> List[Dict[str, Any]]:
     """Получает список продуктов из Strapi CMS только с нужными полями."""
     logger.info("Вызвана функция get_products")
@@ -40,12 +84,18 @@ def get_products(strapi_api_token: str, strapi_url: str) -> List[Dict[str, Any]]
     return products
 
 
+@single_flight
+def _download_image(full_image_url: str) -> bytes:
+    """Скачивает картинку по полному URL."""
+    response = requests.get(full_image_url)
+    response.raise_for_status()
+    return response.content
+
+
 def get_product_image(strapi_url: str, image_url: str) -> BytesIO:
     """Получает картинку товара по URL."""
     full_image_url = urljoin(strapi_url, image_url)
-    response = requests.get(full_image_url)
-    response.raise_for_status()
-    return BytesIO(response.content)
+    return BytesIO(_download_image(full_image_url))
 
 
 def create_client(tg_id: str, strapi_api_token: str, strapi_url: str, email: str) -> Optional[int]:
@@ -102,6 +152,7 @@ def create_cart(tg_id: str, strapi_api_token: str, strapi_url: str) -> Optional[
     return response.json()['id']
 
 
+@single_flight
 def get_cart(tg_id: str, strapi_api_token: str, strapi_url: str) -> Optional[int]:
     """Получает ID корзины по tg_id пользователя."""
     url = urljoin(strapi_url, '/api/carts')
@@ -328,3 +379,71 @@ def delete_cart_item(cart_item_id: Optional[Union[int, str]] = None,
     else:
         logger.error("Не указаны необходимые параметры для работы с корзиной")
         return False
+
+
+def create_order(tg_id: str, client_id: int, cart_items: List[Dict[str, Any]],
+                 idempotency_key: str, strapi_api_token: str, strapi_url: str) -> Optional[int]:
+    """
+    Создает заказ из снимка корзины,
+    или возвращает ID заказа, уже созданного с этим ключом идемпотентности.
+    """
+    url = urljoin(strapi_url, '/api/orders')
+    headers = {
+        'Authorization': f'Bearer {strapi_api_token}',
+        'Content-Type': 'application/json'
+    }
+
+    params = {"filters[idempotency_key][$eq]": idempotency_key}
+    response = requests.get(url, headers=headers, params=params)
+    response.raise_for_status()
+
+    orders = response.json()
+
+    if orders and len(orders) > 0:
+        return orders[0]['id']
+
+    order_details = {
+        "tg_id": tg_id,
+        "client": client_id,
+        "idempotency_key": idempotency_key,
+        "items": [
+            {
+                'product_id': item.get('id'),
+                'title': item.get('title'),
+                'price': item.get('price', 0),
+                'quantity': item.get('quantity', 1)
+            }
+            for item in cart_items
+        ],
+        "total": sum(item.get('price', 0) * item.get('quantity', 1) for item in cart_items)
+    }
+
+    response = requests.post(url, headers=headers, json=order_details)
+    response.raise_for_status()
+
+    order = response.json()
+
+    if 'id' in order:
+        return order['id']
+
+    return order['data']['id']
+
+
+def delete_cart_items(cart_item_ids: List[Union[int, str]], strapi_api_token: str, strapi_url: str) -> None:
+    """Удаляет позиции корзины по списку ID одной сессией.
+
+    Уже удаленные позиции (404) пропускаются, поэтому повторный вызов безопасен.
+    """
+    headers = {
+        'Authorization': f'Bearer {strapi_api_token}',
+        'Content-Type': 'application/json'
+    }
+
+    with requests.Session() as session:
+        session.headers.update(headers)
+        for cart_item_id in cart_item_ids:
+            delete_url = urljoin(strapi_url, f'/api/cart-items/{cart_item_id}')
+            delete_response = session.delete(delete_url)
+            if delete_response.status_code == 404:
+                continue
+            delete_response.raise_for_status()
@@ -0,0 +1,217 @@
+import json
+
+import pytest
+
+import checkout_queue
+from checkout_queue import (
+    CHECKOUT_DELAYED_QUEUE, CHECKOUT_FAILED_QUEUE, CHECKOUT_MAX_ATTEMPTS,
+    CHECKOUT_PROCESSING_QUEUE, CHECKOUT_QUEUE, enqueue_checkout,
+    get_cart_order_key, handle_checkout_job, move_due_retries
+)
+
+
+class FakeRedis:
+    """Минимальная замена Redis для команд, которые использует очередь заказов."""
+
+    def __init__(self):
+        self.data = {}
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.data:
+            return None
+        self.data[key] = str(value)
+        return True
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def lpush(self, key, value):
+        self.data.setdefault(key, []).insert(0, value)
+
+    def lrem(self, key, count, value):
+        self.data.get(key, []).remove(value)
+
+    def rpoplpush(self, source, destination):
+        if not self.data.get(source):
+            return None
+        value = self.data[source].pop()
+        self.lpush(destination, value)
+        return value
+
+    def zadd(self, key, mapping):
+        self.data.setdefault(key, {}).update(mapping)
+
+    def zrangebyscore(self, key, min_score, max_score):
+        return [member for member, score in self.data.get(key, {}).items()
+                if min_score <= score <= max_score]
+
+    def zrem(self, key, member):
+        return self.data.get(key, {}).pop(member, None) is not None
+
+    def hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    def hset(self, key, field, value):
+        self.data.setdefault(key, {})[field] = str(value)
+
+    def expire(self, key, ttl):
+        pass
+
+
+class FakeScheduler:
+    def __init__(self):
+        self.messages = []
+
+    def send_message(self, chat_id, text):
+        self.messages.append((chat_id, text))
+
+
+CART_ITEMS = [
+    {'id': 1, 'title': 'Лосось', 'price': 100, 'quantity': 2, 'cart_item_id': 11},
+    {'id': 2, 'title': 'Краб', 'price': 300, 'quantity': 1, 'cart_item_id': 12},
+]
+
+
+@pytest.fixture
+def strapi(monkeypatch):
+    """Подменяет вызовы Strapi и считает их."""
+    calls = {'create_client': 0, 'create_order': [], 'delete_cart_items': []}
+    failures = {'create_order': 0}
+    orders = {}
+
+    def create_client(tg_id, strapi_api_token, strapi_url, email):
+        calls['create_client'] += 1
+        return 7
+
+    def create_order(tg_id, client_id, cart_items, idempotency_key, strapi_api_token, strapi_url):
+        calls['create_order'].append(idempotency_key)
+        if failures['create_order']:
+            failures['create_order'] -= 1
+            raise ConnectionError('Strapi недоступен')
+        return orders.setdefault(idempotency_key, len(orders) + 100)
+
+    def delete_cart_items(cart_item_ids, strapi_api_token, strapi_url):
+        calls['delete_cart_items'].append(cart_item_ids)
+
+    monkeypatch.setattr(checkout_queue, 'create_client', create_client)
+    monkeypatch.setattr(checkout_queue, 'create_order', create_order)
+    monkeypatch.setattr(checkout_queue, 'delete_cart_items', delete_cart_items)
+    monkeypatch.setattr(checkout_queue, 'get_products_from_cart', lambda *args: CART_ITEMS)
+    return calls, failures
+
+
+def take_job(redis_db):
+    return redis_db.rpoplpush(CHECKOUT_QUEUE, CHECKOUT_PROCESSING_QUEUE)
+
+
+def test_enqueue_skips_redelivered_update():
+    redis_db = FakeRedis()
+
+    assert enqueue_checkout(redis_db, '42', 'fish@example.com', '42:1')
+    assert not enqueue_checkout(redis_db, '42', 'fish@example.com', '42:1')
+    assert len(redis_db.data[CHECKOUT_QUEUE]) == 1
+
+
+def test_enqueue_releases_guard_when_push_fails(monkeypatch):
+    redis_db = FakeRedis()
+
+    def broken_lpush(key, value):
+        raise ConnectionError('Redis недоступен')
+
+    monkeypatch.setattr(redis_db, 'lpush', broken_lpush)
+    with pytest.raises(ConnectionError):
+        enqueue_checkout(redis_db, '42', 'fish@example.com', '42:1')
+
+    monkeypatch.undo()
+    assert enqueue_checkout(redis_db, '42', 'fish@example.com', '42:1')
+
+
+def test_failed_job_resumes_from_progress_after_delay(strapi, monkeypatch):
+    calls, failures = strapi
+    failures['create_order'] = 1
+    redis_db = FakeRedis()
+    scheduler = FakeScheduler()
+    now = 1000.0
+    monkeypatch.setattr(checkout_queue.time, 'time', lambda: now)
+
+    enqueue_checkout(redis_db, '42', 'fish@example.com', '42:1')
+    handle_checkout_job(take_job(redis_db), redis_db, 'token', 'url', scheduler)
+
+    assert redis_db.data[CHECKOUT_PROCESSING_QUEUE] == []
+    assert len(redis_db.data[CHECKOUT_DELAYED_QUEUE]) == 1
+    move_due_retries(redis_db)
+    assert not redis_db.data.get(CHECKOUT_QUEUE)
+
+    now += checkout_queue.CHECKOUT_RETRY_DELAY
+    move_due_retries(redis_db)
+    raw_job = take_job(redis_db)
+    assert json.loads(raw_job)['attempts'] == 1
+    handle_checkout_job(raw_job, redis_db, 'token', 'url', scheduler)
+
+    assert calls['create_client'] == 1
+    assert calls['create_order'] == [get_cart_order_key('42', CART_ITEMS)] * 2
+    assert calls['delete_cart_items'] == [[11, 12]]
+    assert redis_db.hgetall('checkout:progress:42:1')['done'] == '1'
+    assert scheduler.messages == [('42', 'Заказ №100 оформлен.')]
+
+
+def test_job_moves_to_failed_after_max_attempts(strapi, monkeypatch):
+    calls, failures = strapi
+    failures['create_order'] = CHECKOUT_MAX_ATTEMPTS
+    redis_db = FakeRedis()
+    scheduler = FakeScheduler()
+    monkeypatch.setattr(checkout_queue.time, 'time', lambda: 0)
+
+    enqueue_checkout(redis_db, '42', 'fish@example.com', '42:1')
+    for _ in range(CHECKOUT_MAX_ATTEMPTS):
+        handle_checkout_job(take_job(redis_db), redis_db, 'token', 'url', scheduler)
+        for raw_job in list(redis_db.data.get(CHECKOUT_DELAYED_QUEUE, {})):
+            redis_db.zrem(CHECKOUT_DELAYED_QUEUE, raw_job)
+            redis_db.lpush(CHECKOUT_QUEUE, raw_job)
+
+    assert len(redis_db.data[CHECKOUT_FAILED_QUEUE]) == 1
+    assert not redis_db.data.get(CHECKOUT_QUEUE)
+    assert calls['delete_cart_items'] == []
+    assert scheduler.messages == [('42', "Не удалось оформить заказ. Пожалуйста, попробуйте позже.")]
+
+
+def test_second_checkout_of_same_cart_reuses_order(strapi):
+    calls, _ = strapi
+    redis_db = FakeRedis()
+
+    enqueue_checkout(redis_db, '42', 'fish@example.com', '42:1')
+    enqueue_checkout(redis_db, '42', 'fish@example.com', '42:2')
+    handle_checkout_job(take_job(redis_db), redis_db, 'token', 'url')
+    handle_checkout_job(take_job(redis_db), redis_db, 'token', 'url')
+
+    assert calls['create_order'][0] == calls['create_order'][1]
+    assert redis_db.hgetall('checkout:progress:42:1')['order_id'] == '100'
+    assert redis_db.hgetall('checkout:progress:42:2')['order_id'] == '100'
+
+
+def test_job_is_delayed_while_user_checkout_is_running(strapi):
+    calls, _ = strapi
+    redis_db = FakeRedis()
+    redis_db.set('checkout:lock:42', '42:1')
+
+    enqueue_checkout(redis_db, '42', 'fish@example.com', '42:2')
+    handle_checkout_job(take_job(redis_db), redis_db, 'token', 'url')
+
+    delayed_jobs = [json.loads(raw_job) for raw_job in redis_db.data[CHECKOUT_DELAYED_QUEUE]]
+    assert delayed_jobs[0]['attempts'] == 0
+    assert calls['create_client'] == 0
+    assert redis_db.data[CHECKOUT_PROCESSING_QUEUE] == []
+
+
+def test_empty_cart_is_reported(strapi, monkeypatch):
+    monkeypatch.setattr(checkout_queue, 'get_products_from_cart', lambda *args: [])
+    redis_db = FakeRedis()
+    scheduler = FakeScheduler()
+
+    enqueue_checkout(redis_db, '42', 'fish@example.com', '42:1')
+    handle_checkout_job(take_job(redis_db), redis_db, 'token', 'url', scheduler)
+
+    assert scheduler.messages == [('42', "Корзина пуста, заказ не создан.")]
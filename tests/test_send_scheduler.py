@@ -0,0 +1,160 @@
+import threading
+import time
+
+from telegram.error import RetryAfter
+
+from send_scheduler import PRIORITY_BULK, SendScheduler, TokenBucket, iter_chat_ids
+
+
+class FakeBot:
+    """Записывает отправленные сообщения, может отвечать 429 или ошибкой."""
+
+    def __init__(self, retry_after=None, failing_texts=()):
+        self.sent = []
+        self.retry_after = dict(retry_after or {})
+        self.failing_texts = failing_texts
+        self.lock = threading.Lock()
+        self.started_at = time.monotonic()
+
+    def send_message(self, chat_id, text):
+        if text in self.failing_texts:
+            raise ConnectionError('сеть недоступна')
+        with self.lock:
+            if self.retry_after.get(text):
+                raise RetryAfter(self.retry_after.pop(text))
+            self.sent.append((chat_id, text, time.monotonic() - self.started_at))
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert condition()
+
+
+def test_token_bucket_limits_rate():
+    bucket = TokenBucket(rate=2, capacity=1)
+    now = bucket.updated_at
+
+    assert bucket.time_until_available(now) == 0
+    bucket.consume(now)
+    assert bucket.time_until_available(now) == 0.5
+    assert bucket.time_until_available(now + 0.5) == 0
+
+
+def test_token_bucket_pause():
+    bucket = TokenBucket(rate=10, capacity=10)
+    now = bucket.updated_at
+
+    bucket.pause(now + 1)
+
+    assert bucket.time_until_available(now) == 1
+    assert not bucket.is_full(now)
+    assert bucket.time_until_available(now + 1) == 0
+
+
+def test_messages_of_one_chat_keep_order():
+    bot = FakeBot()
+    scheduler = SendScheduler(bot, per_chat_rate=50, sender_threads=4)
+    scheduler.start()
+
+    for number in range(20):
+        for chat_id in (1, 2, 3):
+            scheduler.send_message(chat_id, text=f'{chat_id}:{number}')
+    wait_for(lambda: len(bot.sent) == 60)
+    scheduler.stop()
+
+    for chat_id in (1, 2, 3):
+        texts = [text for sent_chat_id, text, _ in bot.sent if sent_chat_id == chat_id]
+        assert texts == [f'{chat_id}:{number}' for number in range(20)]
+
+
+def test_interactive_lane_goes_before_bulk():
+    bot = FakeBot()
+    scheduler = SendScheduler(bot, sender_threads=1)
+
+    for chat_id in range(10):
+        scheduler.send_message(chat_id, priority=PRIORITY_BULK, text='акция')
+    scheduler.send_message(100, text='ответ')
+    scheduler.start()
+    wait_for(lambda: len(bot.sent) == 11)
+    scheduler.stop()
+
+    assert bot.sent[0][1] == 'ответ'
+
+
+def test_retry_after_pauses_only_its_chat():
+    bot = FakeBot(retry_after={'первое': 1})
+    scheduler = SendScheduler(bot, sender_threads=2)
+    scheduler.start()
+
+    scheduler.send_message(1, text='первое')
+    scheduler.send_message(2, text='другой чат')
+    wait_for(lambda: len(bot.sent) == 2)
+    scheduler.stop()
+
+    sent = {text: sent_at for _, text, sent_at in bot.sent}
+    assert sent['другой чат'] < 0.5
+    assert sent['первое'] >= 1
+
+
+def test_bulk_retry_after_does_not_stall_interactive_replies():
+    bot = FakeBot(retry_after={'акция': 1})
+    scheduler = SendScheduler(bot, sender_threads=2)
+    scheduler.start()
+
+    scheduler.send_message(1, priority=PRIORITY_BULK, text='акция')
+    scheduler.send_message(2, priority=PRIORITY_BULK, text='вторая акция')
+    time.sleep(0.1)
+    scheduler.send_message(3, text='ответ')
+    wait_for(lambda: len(bot.sent) == 3)
+    scheduler.stop()
+
+    sent = {text: sent_at for _, text, sent_at in bot.sent}
+    assert sent['ответ'] < 0.5
+    assert sent['вторая акция'] >= 1
+
+
+def test_sender_survives_unexpected_error():
+    bot = FakeBot(failing_texts=('сломанное',))
+    errors = []
+    scheduler = SendScheduler(bot, sender_threads=1)
+    scheduler.start()
+
+    scheduler.send_message(1, text='сломанное', on_error=errors.append)
+    scheduler.send_message(1, text='после ошибки')
+    scheduler.send_message(2, text='другой чат')
+    wait_for(lambda: len(bot.sent) == 2)
+    scheduler.stop()
+
+    assert [text for _, text, _ in bot.sent] == ['после ошибки', 'другой чат']
+    assert isinstance(errors[0], ConnectionError)
+
+
+def test_bulk_backpressure_bounds_queue():
+    bot = FakeBot()
+    scheduler = SendScheduler(bot, bulk_queue_size=5, sender_threads=1)
+    scheduler.start()
+    max_queued = []
+
+    for chat_id in range(30):
+        scheduler.send_message(chat_id, priority=PRIORITY_BULK, text='акция')
+        max_queued.append(len(scheduler._lanes[PRIORITY_BULK]))
+    wait_for(lambda: len(bot.sent) == 30)
+    scheduler.stop()
+
+    assert max(max_queued) <= 5
+
+
+class FakeRedis:
+    def __init__(self, keys):
+        self.keys = keys
+
+    def scan_iter(self, count):
+        return iter(self.keys)
+
+
+def test_iter_chat_ids_skips_service_keys():
+    redis_db = FakeRedis(['12', '-100500', 'checkout:queue', 'bot:snapshot'])
+
+    assert list(iter_chat_ids(redis_db)) == [12, -100500]
@@ -0,0 +1,93 @@
+import threading
+import time
+
+import pytest
+
+from strapi_service import single_flight
+
+
+def run_concurrently(func, args_list):
+    results = []
+    results_lock = threading.Lock()
+
+    def call(args):
+        try:
+            result = func(*args)
+        except Exception as e:
+            result = e
+        with results_lock:
+            results.append(result)
+
+    threads = [threading.Thread(target=call, args=(args,)) for args in args_list]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_single_flight_shares_one_call_between_concurrent_callers():
+    calls = []
+
+    @single_flight
+    def get_products(token, url):
+        calls.append((token, url))
+        time.sleep(0.2)
+        return ['Лосось']
+
+    results = run_concurrently(get_products, [('token', 'url')] * 10)
+
+    assert calls == [('token', 'url')]
+    assert results == [['Лосось']] * 10
+
+
+def test_single_flight_passes_same_exception_to_every_waiter():
+    calls = []
+    error = ConnectionError('Strapi недоступен')
+
+    @single_flight
+    def get_cart(tg_id):
+        calls.append(tg_id)
+        time.sleep(0.2)
+        raise error
+
+    results = run_concurrently(get_cart, [('42',)] * 5)
+
+    assert calls == ['42']
+    assert all(result is error for result in results)
+
+
+def test_single_flight_keeps_different_arguments_separate():
+    calls = []
+
+    @single_flight
+    def get_cart(tg_id):
+        calls.append(tg_id)
+        time.sleep(0.1)
+        return f'cart-{tg_id}'
+
+    results = run_concurrently(get_cart, [('1',), ('2',), ('1',)])
+
+    assert sorted(calls) == ['1', '2']
+    assert sorted(results) == ['cart-1', 'cart-1', 'cart-2']
+
+
+def test_single_flight_does_not_cache_finished_calls():
+    calls = []
+
+    @single_flight
+    def get_products():
+        calls.append(1)
+        return len(calls)
+
+    assert get_products() == 1
+    assert get_products() == 2
+
+    @single_flight
+    def broken():
+        raise ValueError('ошибка')
+
+    with pytest.raises(ValueError):
+        broken()
+    with pytest.raises(ValueError):
+        broken()
@@ -0,0 +1,114 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import tg_bot
+
+
+class FakeDispatcher:
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        self.errors = []
+
+    def run_async(self, func, *args, update=None, **kwargs):
+        return self.executor.submit(func, *args, **kwargs)
+
+    def dispatch_error(self, update, error):
+        self.errors.append(error)
+
+
+def make_update(chat_id, number):
+    return SimpleNamespace(effective_chat=SimpleNamespace(id=chat_id), number=number)
+
+
+def test_updates_of_one_chat_are_handled_in_order(monkeypatch):
+    handled = []
+    handled_lock = threading.Lock()
+    active_chats = set()
+    overlaps = []
+
+    def handle_users_reply(update, context):
+        chat_id = update.effective_chat.id
+        with handled_lock:
+            if chat_id in active_chats:
+                overlaps.append(chat_id)
+            active_chats.add(chat_id)
+        time.sleep(0.01)
+        with handled_lock:
+            active_chats.discard(chat_id)
+            handled.append((chat_id, update.number))
+        if update.number == 3:
+            raise ValueError('ошибка обработчика')
+
+    monkeypatch.setattr(tg_bot, 'handle_users_reply', handle_users_reply)
+    dispatcher = FakeDispatcher()
+    context = SimpleNamespace(dispatcher=dispatcher)
+
+    for number in range(10):
+        for chat_id in (1, 2):
+            tg_bot.queue_users_reply(make_update(chat_id, number), context)
+    dispatcher.executor.shutdown(wait=True)
+
+    assert overlaps == []
+    for chat_id in (1, 2):
+        assert [number for handled_chat, number in handled if handled_chat == chat_id] == list(range(10))
+    assert len(dispatcher.errors) == 2
+    assert tg_bot._chat_updates == {}
+
+
+class FakeSendScheduler:
+    def __init__(self):
+        self.photos = []
+
+    def send_photo(self, chat_id, **kwargs):
+        self.photos.append((chat_id, kwargs))
+
+
+class RecordingDispatcher:
+    def __init__(self, bot_data):
+        self.bot_data = bot_data
+        self.async_calls = []
+
+    def run_async(self, func, *args, **kwargs):
+        self.async_calls.append((func, args))
+
+
+def make_photo_dispatcher(monkeypatch):
+    forgotten = []
+    monkeypatch.setattr(
+        tg_bot, 'forget_image_file_id',
+        lambda bot_data, image_url: forgotten.append(image_url)
+    )
+    dispatcher = RecordingDispatcher({
+        'send_scheduler': FakeSendScheduler(),
+        'image_file_ids': {'/fish.png': 'FILE_ID'},
+    })
+    return dispatcher, forgotten
+
+
+def test_invalid_file_id_is_forgotten_and_resent_off_sender_thread(monkeypatch):
+    dispatcher, forgotten = make_photo_dispatcher(monkeypatch)
+
+    tg_bot.send_product_photo(dispatcher, 1, '/fish.png', 'Лосось', None, 'url')
+    _, photo = dispatcher.bot_data['send_scheduler'].photos[0]
+    assert photo['photo'] == 'FILE_ID'
+
+    photo['on_error'](tg_bot.BadRequest('Wrong file identifier/http url specified'))
+
+    assert forgotten == ['/fish.png']
+    assert dispatcher.async_calls == [
+        (tg_bot.send_product_photo, (dispatcher, 1, '/fish.png', 'Лосось', None, 'url'))
+    ]
+
+
+def test_other_bad_requests_keep_file_id(monkeypatch):
+    dispatcher, forgotten = make_photo_dispatcher(monkeypatch)
+
+    tg_bot.send_product_photo(dispatcher, 1, '/fish.png', 'Лосось', None, 'url')
+    _, photo = dispatcher.bot_data['send_scheduler'].photos[0]
+    photo['on_error'](tg_bot.BadRequest('Chat not found'))
+    photo['on_error'](tg_bot.BadRequest('Message caption is too long'))
+
+    assert forgotten == []
+    assert dispatcher.async_calls == []
@@ -1,19 +1,28 @@
 import os
 import logging
+import threading
 import redis
+from collections import deque
 from email_validator import EmailNotValidError, validate_email
 from environs import Env
 from functools import partial
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
 from telegram.ext import Filters, Updater, CallbackContext
 from telegram.ext import CallbackQueryHandler, CommandHandler, MessageHandler
 
 from strapi_service import (
-    get_products, get_product_image, get_cart,
-    add_to_cart_item, get_products_from_cart, create_client,
+    get_product_image, get_cart,
+    add_to_cart_item, get_products_from_cart,
     create_cart, format_cart_content, delete_cart_item
 )
+from checkout_queue import enqueue_checkout, start_checkout_workers, stop_checkout_workers
+from send_scheduler import SendScheduler, start_broadcast
+from bot_snapshot import (
+    CATALOG_REFRESH_INTERVAL, load_snapshot, refresh_catalog, is_catalog_stale,
+    refresh_catalog_job, remember_image_file_id, forget_image_file_id
+)
 
 
 STATE_START = 'START'
@@ -22,6 +31,12 @@ STATE_HANDLE_DESCRIPTION = 'HANDLE_DESCRIPTION'
 STATE_GET_CART_MENU = 'GET_CART_MENU'
 STATE_WAITING_EMAIL = 'WAITING_EMAIL'
 
+INVALID_FILE_ID_ERRORS = (
+    'wrong file identifier',
+    'file reference expired',
+    'wrong remote file id',
+)
+
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -32,6 +47,9 @@ logger = logging.getLogger(__name__)
 
 _database = None
 
+_chat_updates = {}
+_chat_updates_lock = threading.Lock()
+
 
 def get_database_connection(host, port, password):
     """Возвращает подключение к Redis."""
@@ -44,28 +62,25 @@ def get_database_connection(host, port, password):
 
 def start(update, context, strapi_api_token, strapi_url):
     """Показывает меню товаров."""
-    if 'menu_items' not in context.bot_data or (update.message and update.message.text == '/start'):
-        menu_items = get_products(strapi_api_token, strapi_url)
-        context.bot_data['menu_items'] = menu_items
-    else:
-        menu_items = context.bot_data['menu_items']
+    if 'menu_keyboard' not in context.bot_data:
+        refresh_catalog(context.bot_data)
+    elif update.message and update.message.text == '/start' and is_catalog_stale(context.bot_data):
+        context.dispatcher.run_async(refresh_catalog, context.bot_data)
 
-    menu_buttons = [
-        [InlineKeyboardButton(item.get('title'), callback_data=str(item.get('id')))]
-        for item in menu_items
-    ]
-    menu_buttons.append([
-        InlineKeyboardButton("🛒 Моя корзина", callback_data='show_cart')
-    ])
+    menu_keyboard = context.bot_data['menu_keyboard']
 
     if update.message:
-        update.message.reply_text("Выберите товар:", reply_markup=InlineKeyboardMarkup(menu_buttons))
+        context.bot_data['send_scheduler'].send_message(
+            chat_id=update.message.chat_id,
+            text="Выберите товар:",
+            reply_markup=menu_keyboard
+        )
     else:
         query = update.callback_query
-        context.bot.send_message(
+        context.bot_data['send_scheduler'].send_message(
             chat_id=query.message.chat_id,
             text="Товары списком:",
-            reply_markup=InlineKeyboardMarkup(menu_buttons)
+            reply_markup=menu_keyboard
         )
         try:
             query.message.delete()
@@ -94,7 +109,7 @@ def handle_menu(update, context, strapi_api_token, strapi_url):
     menu_items = context.bot_data['menu_items']
     selected_product = next((p for p in menu_items if str(p['id']) == query.data), None)
     if not selected_product:
-        context.bot.send_message(
+        context.bot_data['send_scheduler'].send_message(
             chat_id=query.message.chat_id,
             text="Товар не найден",
             reply_markup=InlineKeyboardMarkup([[
@@ -115,16 +130,14 @@ def handle_menu(update, context, strapi_api_token, strapi_url):
         InlineKeyboardButton("🛒 Моя корзина", callback_data='show_cart')
     ]]
 
-    image_data = get_product_image(strapi_url, selected_product['small_image_url'])
-    if image_data:
-        context.bot.send_photo(
-            chat_id=query.message.chat_id,
-            photo=image_data,
-            caption=message,
-            reply_markup=InlineKeyboardMarkup(keyboard)
+    image_url = selected_product['small_image_url']
+    if image_url:
+        send_product_photo(
+            context.dispatcher, query.message.chat_id, image_url,
+            message, InlineKeyboardMarkup(keyboard), strapi_url
         )
     else:
-        context.bot.send_message(
+        context.bot_data['send_scheduler'].send_message(
             chat_id=query.message.chat_id,
             text=message,
             reply_markup=InlineKeyboardMarkup(keyboard)
@@ -137,6 +150,57 @@ def handle_menu(update, context, strapi_api_token, strapi_url):
     return STATE_HANDLE_DESCRIPTION
 
 
+def send_product_photo(dispatcher, chat_id, image_url, caption, reply_markup, strapi_url):
+    """Отправляет фото товара по сохраненному file_id или скачивает его из Strapi."""
+    bot_data = dispatcher.bot_data
+    send_scheduler = bot_data['send_scheduler']
+    file_id = bot_data['image_file_ids'].get(image_url)
+    if file_id:
+        send_scheduler.send_photo(
+            chat_id=chat_id,
+            photo=file_id,
+            caption=caption,
+            reply_markup=reply_markup,
+            on_error=partial(
+                resend_product_photo, dispatcher, chat_id, image_url,
+                caption, reply_markup, strapi_url
+            )
+        )
+        return
+
+    image_data = get_product_image(strapi_url, image_url)
+    send_scheduler.send_photo(
+        chat_id=chat_id,
+        photo=image_data,
+        caption=caption,
+        reply_markup=reply_markup,
+        on_sent=partial(remember_image_file_id, bot_data, image_url)
+    )
+
+
+def is_invalid_file_id_error(error):
+    """Проверяет, что Telegram отклонил именно file_id, а не само сообщение."""
+    if not isinstance(error, BadRequest):
+        return False
+    error_text = str(error).lower()
+    return any(marker in error_text for marker in INVALID_FILE_ID_ERRORS)
+
+
+def resend_product_photo(dispatcher, chat_id, image_url, caption, reply_markup, strapi_url, error):
+    """Забывает недействительный file_id и отправляет картинку заново из Strapi.
+
+    Вызывается из потока отправки, поэтому скачивание картинки
+    передается в пул потоков диспетчера.
+    """
+    if not is_invalid_file_id_error(error):
+        return
+    logger.warning(f"file_id картинки {image_url} отклонен Telegram: {error}")
+    forget_image_file_id(dispatcher.bot_data, image_url)
+    dispatcher.run_async(
+        send_product_photo, dispatcher, chat_id, image_url, caption, reply_markup, strapi_url
+    )
+
+
 def show_cart(update, context, strapi_api_token, strapi_url):
     """Показывает корзину пользователя."""
     chat_id = update.callback_query.message.chat_id if update.callback_query else update.message.chat_id
@@ -179,7 +243,7 @@ def show_cart(update, context, strapi_api_token, strapi_url):
         except:
             pass
         
-        context.bot.send_message(
+        context.bot_data['send_scheduler'].send_message(
             chat_id=chat_id,
             text=cart_summary,
             reply_markup=keyboard
@@ -204,7 +268,7 @@ def handle_cart_action(update, context, strapi_api_token, strapi_url):
     except:
         pass
         
-    context.bot.send_message(
+    context.bot_data['send_scheduler'].send_message(
         chat_id=tg_id,
         text="✅ Товар добавлен в корзину!",
         reply_markup=InlineKeyboardMarkup([[
@@ -248,7 +312,7 @@ def clear_cart(update, context, strapi_api_token, strapi_url):
     except:
         pass
 
-    context.bot.send_message(
+    context.bot_data['send_scheduler'].send_message(
         chat_id=tg_id,
         text="✅ Корзина очищена!",
         reply_markup=InlineKeyboardMarkup([[
@@ -271,7 +335,10 @@ def handle_email_input(update, context, strapi_api_token, strapi_url):
     try:
         valid = validate_email(email, check_deliverability=False)
         normalized_email = valid.normalized
-        create_client(chat_id, strapi_api_token, strapi_url, normalized_email)
+        enqueue_checkout(
+            context.bot_data['db'], chat_id, normalized_email,
+            idempotency_key=f"{chat_id}:{update.message.message_id}"
+        )
 
         try:
             update.message.delete()
@@ -279,15 +346,15 @@ def handle_email_input(update, context, strapi_api_token, strapi_url):
         except Exception:
             pass
 
-        context.bot.send_message(
+        context.bot_data['send_scheduler'].send_message(
             chat_id=chat_id,
-            text=f"Ваш email {normalized_email} принят. Заказ оформлен."
+            text=f"Ваш email {normalized_email} принят. Заказ принят в обработку."
         )
 
         return start(update, context, strapi_api_token, strapi_url)
 
     except EmailNotValidError:
-        context.bot.send_message(
+        context.bot_data['send_scheduler'].send_message(
             chat_id=chat_id,
             text="Неверный формат email. Пожалуйста, введите корректный email:"
         )
@@ -303,6 +370,65 @@ def delete_message(update, context):
         pass
 
 
+def handle_broadcast(update, context):
+    """Рассылает сообщение всем пользователям бота."""
+    if update.effective_user.id not in context.bot_data['admin_ids']:
+        return
+
+    send_scheduler = context.bot_data['send_scheduler']
+    message = update.effective_message
+    text = message.text.partition(' ')[2].strip()
+    if not text:
+        send_scheduler.send_message(
+            chat_id=message.chat_id,
+            text="Укажите текст рассылки: /broadcast <текст>"
+        )
+        return
+
+    start_broadcast(context.bot_data['db'], send_scheduler, text)
+    send_scheduler.send_message(
+        chat_id=message.chat_id,
+        text="Рассылка запущена"
+    )
+
+
+def queue_users_reply(update, context):
+    """Передает обновление на обработку, сохраняя порядок внутри чата.
+
+    Вызывается синхронно в потоке диспетчера, поэтому обновления попадают
+    в очередь чата в порядке поступления. Разные чаты обрабатываются
+    параллельно, а обновления одного чата - строго по одному.
+    """
+    if not update.effective_chat:
+        return
+    chat_id = update.effective_chat.id
+
+    with _chat_updates_lock:
+        chat_updates = _chat_updates.get(chat_id)
+        if chat_updates is not None:
+            chat_updates.append((update, context))
+            return
+        _chat_updates[chat_id] = deque()
+
+    context.dispatcher.run_async(process_chat_updates, chat_id, update, context, update=update)
+
+
+def process_chat_updates(chat_id, update, context):
+    """Обрабатывает обновление и все накопившиеся за ним обновления чата."""
+    while True:
+        try:
+            handle_users_reply(update, context)
+        except Exception as e:
+            context.dispatcher.dispatch_error(update, e)
+
+        with _chat_updates_lock:
+            chat_updates = _chat_updates[chat_id]
+            if not chat_updates:
+                del _chat_updates[chat_id]
+                return
+            update, context = chat_updates.popleft()
+
+
 def handle_users_reply(update, context):
     """Единая функция обработки сообщений пользователя."""
     strapi_api_token = context.bot_data['strapi_api_token']
@@ -348,7 +474,7 @@ def handle_users_reply(update, context):
 
         if user_reply == 'checkout':
             delete_message(update, context)
-            context.bot.send_message(
+            context.bot_data['send_scheduler'].send_message(
                 chat_id=chat_id,
                 text="Пожалуйста, введите ваш email для оформления заказа:"
             )
@@ -381,6 +507,8 @@ def main():
     database_port = env.str("REDIS_DATABASE_PORT")
     database_password = env.str("REDIS_DATABASE_PASSWORD")
     token = env.str("TG_BOT_TOKEN")
+    checkout_workers = env.int("CHECKOUT_WORKERS", 4)
+    admin_ids = env.list("TG_ADMIN_IDS", [], subcast=int)
     
     logger.info("Запуск бота...")
     
@@ -392,14 +520,30 @@ def main():
     dispatcher.bot_data['strapi_api_token'] = strapi_api_token
     dispatcher.bot_data['strapi_url'] = strapi_url
     dispatcher.bot_data['db'] = db
+    dispatcher.bot_data['admin_ids'] = admin_ids
+
+    send_scheduler = SendScheduler(updater.bot)
+    send_scheduler.start()
+    dispatcher.bot_data['send_scheduler'] = send_scheduler
+
+    if not load_snapshot(dispatcher.bot_data):
+        logger.info("Снимок каталога не найден, каталог будет загружен из Strapi")
+    updater.job_queue.run_repeating(refresh_catalog_job, interval=CATALOG_REFRESH_INTERVAL, first=0)
+
+    checkout_stop_event, checkout_threads = start_checkout_workers(
+        db, strapi_api_token, strapi_url, send_scheduler, checkout_workers
+    )
 
-    dispatcher.add_handler(CommandHandler('start', handle_users_reply))
-    dispatcher.add_handler(CallbackQueryHandler(handle_users_reply))
-    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_users_reply))
+    dispatcher.add_handler(CommandHandler('start', queue_users_reply))
+    dispatcher.add_handler(CommandHandler('broadcast', handle_broadcast))
+    dispatcher.add_handler(CallbackQueryHandler(queue_users_reply))
+    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, queue_users_reply))
     dispatcher.add_error_handler(lambda update, context: logger.error(f"Ошибка: {context.error}"))
 
     updater.start_polling()
     updater.idle()
+    stop_checkout_workers(checkout_stop_event, checkout_threads)
+    send_scheduler.stop()
 
 
 if __name__ == '__main__':